@@ -49,17 +49,22 @@ for stats in SL.get_stats_from_cv(confusion_matrix=False,kappa=True):
 ##############################################################################
 # Get each confusion matrix from folds
 # -----------------------------------------------
-cms = []
+# Sum matrices fold after fold to only keep one matrix in memory
+
+total_cm = None
+n_folds = 0
 for stats in SL.get_stats_from_cv(confusion_matrix=True):
-    cms.append(stats['confusion_matrix'])
-    print(stats['confusion_matrix'])
+    cm = stats['confusion_matrix']
+    total_cm = cm if total_cm is None else total_cm + cm
+    n_folds += 1
+    print(cm)
     
 ##############################################################################
 # Plot confusion matrix
 # -----------------------------------------------
     
 import numpy as np
-meanCM = np.mean(cms,axis=0).astype(np.int16)
+meanCM = (total_cm // n_folds).astype(np.int16) # counts are positive, no float copy needed
 pltCM = PlotConfusionMatrix(meanCM.T) # Translate for Y = prediction and X = truth
 pltCM.add_text()
 pltCM.color_diagonal()
\ No newline at end of file
@@ -15,7 +15,7 @@
 """
 The :mod:`museotoolbox.ai` module gathers artificial intelligence tools.
 """
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, Memory
 import os
 import numpy as np
 from sklearn import metrics
@@ -24,8 +24,19 @@ from ..processing import RasterMath, get_gdt_from_minmax_values, convert_dt, _re
 from ..internal_tools import ProgressBar, push_feedback
 
 
+def _fit_and_predict(model, X_train, y_train, X_test):
+    """
+    Fit a copy of model on the train set and predict the test set.
+    """
+    model = clone(model)
+    model.fit(X_train, y_train)
+
+    return model.predict(X_test)
+
+
 class SuperLearner:
-    def __init__(self, classifier, param_grid=None, n_jobs=1, verbose=False):
+    def __init__(self, classifier, param_grid=None, n_jobs=1, verbose=False,
+                 cache_dir=None):
         """
         SuperLearner, shortname for Supervised Learning, ease the way to learn a model via an array or a raster using Scikit-Learn algorithm.
         After learning a model via :func:`fit`, you can predict via :func:`predict_image` or :func:`predict_array`.
@@ -40,6 +51,9 @@ class SuperLearner:
             Number of cores to be used by ``sklearn`` in grid-search.
         verbose : bool or int, optional (default=False)
             The higher it is the more sequential will show progression.
+        cache_dir : str or None, optional (default=None).
+            If a path is given, the fit and prediction of each fold in :func:`get_stats_from_cv` are cached
+            on disk with ``joblib.Memory``, so running again the same cross-validation only reads the results.
 
         Examples
         ---------
@@ -76,6 +90,12 @@ class SuperLearner:
         """
         self.n_jobs = n_jobs
         self.verbose = verbose
+        self.cache_dir = cache_dir
+        if self.cache_dir is None:
+            self._fit_and_predict = _fit_and_predict
+        else:
+            self._fit_and_predict = Memory(
+                self.cache_dir, verbose=0).cache(_fit_and_predict)
 
         if self.verbose <= 1 or self.verbose is False:
             self.verbose_gridsearch = 0
@@ -443,9 +463,8 @@ class SuperLearner:
         X_train, X_test = self.X[trvl[0]], self.X[trvl[1]]
         Y_train, Y_test = self.y[trvl[0]], self.y[trvl[1]]
 
-        self.cloneModel.fit(X_train, Y_train)
-
-        X_pred = self.cloneModel.predict(X_test)
+        X_pred = self._fit_and_predict(
+            self.cloneModel, X_train, Y_train, X_test)
 
         accuracies = {}
         if confusion_matrix:
@@ -97,6 +97,21 @@ class PlotConfusionMatrix:
         self.subplot_ax1v = False
         self.axes.append(self.ax)
 
+        # diagonal, row and column sums, computed once when needed
+        self._reductions = None
+        self._f1 = None
+
+    def _get_reductions(self):
+        """
+        Return the diagonal, the sum of each line and the sum of each column
+        of the confusion matrix.
+        """
+        if self._reductions is None:
+            self._reductions = (np.diag(self.cm_).astype(np.float64),
+                                np.nansum(self.cm_, axis=1),
+                                np.nansum(self.cm_, axis=0))
+        return self._reductions
+
     def _init_gridspec(self):
         self.gs = gridspec.GridSpec(
             2, 3, width_ratios=[
@@ -350,22 +365,17 @@ class PlotConfusionMatrix:
             self.ax2v = plt.subplot(self.gs[0, 2])
             current_ax = self.ax2v
 
-        verticalPlot = []
-
-        for label in range(self.cm.shape[0]):
-            TP = self.cm_[label, label]
-            #TN = np.sum(sp.diag(currentCsv))-currentCsv[label,label]
-            FN = np.nansum(self.cm_[:, label]) - TP
-            FP = np.nansum(self.cm_[label, :]) - TP
-
-            verticalPlot.append(2 * TP / (2 * TP + FP + FN) * 100)
+        # 2*TP+FP+FN is the sum of the line and of the column of each label
+        if self._f1 is None:
+            TP, line_sum, col_sum = self._get_reductions()
+            self._f1 = 2 * TP / (line_sum + col_sum) * 100
 
         if self.font_size is not False:
             font_size = self.font_size
         else:
             font_size = 12
 
-        verticalPlot = np.asarray(verticalPlot).reshape(-1, 1)
+        verticalPlot = self._f1.reshape(-1, 1)
         current_ax.imshow(
             verticalPlot,
             cmap=self.diag_color,
@@ -448,16 +458,18 @@ class PlotConfusionMatrix:
         self.ax1v = plt.subplot(self.gs[0, 1])
         self.ax1h = plt.subplot(self.gs[1, 0])
 
-        self.ax1v.imshow(np.array(np.diag(self.cm_) / np.nansum(self.cm_,
-                                                                axis=1) * 100).reshape(-1,
-                                                                                       1),
+        TP, line_sum, col_sum = self._get_reductions()
+        prod_acc = TP / line_sum * 100
+        user_acc = TP / col_sum * 100
+
+        self.ax1v.imshow(prod_acc.reshape(-1, 1),
                          cmap=self.diag_color,
                          interpolation='nearest',
                          aspect='equal',
                          vmin=0,
                          vmax=100)
 
-        self.ax1h.imshow(np.array(np.diag(self.cm_) / np.nansum(self.cm_, axis=0) * 100).reshape(
+        self.ax1h.imshow(user_acc.reshape(
             1, -1), cmap=self.diag_color, interpolation='nearest', aspect='equal', vmin=0, vmax=100)
 
         self.ax1v.set_yticks(np.arange(self.cm_.shape[0]))
@@ -467,8 +479,7 @@ class PlotConfusionMatrix:
         self.ax1h.set_xticks([])
 
         for i in range(self.cm.shape[0]):
-            iVal = np.int(_nan_to_num(np.array(np.diag(
-                self.cm_) / np.nansum(self.cm_, axis=1) * 100).reshape(-1, 1)[i][0], nan=0))
+            iVal = int(_nan_to_num(prod_acc[i], nan=0))
 
             self.ax1v.text(
                 0,
@@ -481,8 +492,7 @@ class PlotConfusionMatrix:
 
         self.ax1v.set_yticklabels([])
         for j in range(self.cm.shape[1]):
-            jVal = np.int(_nan_to_num(np.array(np.diag(
-                self.cm_) / np.nansum(self.cm_, axis=0) * 100).reshape(-1, 1)[j][0], nan=0))
+            jVal = int(_nan_to_num(user_acc[j], nan=0))
 
             self.ax1h.text(
                 j,
@@ -179,7 +179,7 @@ class SpatialLeaveAsideOut(_sample_selection._cv_manager):
 
     Parameters
     ----------
-    distance_matrix : numpy.ndarray, shape [n_samples, n_samples].
+    distance_matrix : numpy.ndarray, shape [n_samples, n_samples] or condensed [n_samples*(n_samples-1)/2].
         Array got from function samplingMethods.getdistance_matrixForDistanceCV(inRaster,inVector)
     valid_size : float, default 0.5.
         The percentage of validaton to keep : from 0 to 1.
@@ -220,7 +220,7 @@ class SpatialLeaveOneSubGroupOut(_sample_selection._cv_manager):
 
     Parameters
     ----------
-    distance_matrix : numpy.ndarray, shape [n_samples, n_samples].
+    distance_matrix : numpy.ndarray, shape [n_samples, n_samples] or condensed [n_samples*(n_samples-1)/2].
         Array got from function :func:`museotoolbox.vector_tools.get_distance_matrix`
     distance_thresold : int.
         In pixels.
@@ -259,7 +259,7 @@ class SpatialLeaveOneOut(_sample_selection._cv_manager):
 
     Parameters
     ----------
-    distance_matrix : numpy.ndarray, shape [n_samples, n_samples].
+    distance_matrix : numpy.ndarray, shape [n_samples, n_samples] or condensed [n_samples*(n_samples-1)/2].
         Array got from function museotoolbox.vector_tools.get_distance_matrix(inRaster,inVector)
     distance_thresold : int.
         In pixels.
@@ -15,6 +15,7 @@
 import os
 import numpy as np
 from osgeo import ogr
+from scipy.spatial.distance import num_obs_y
 from .. import processing
 
 
@@ -42,7 +43,8 @@ class distanceCV:
         Y : array-like
             contain class for each ROI. Same effective as distance_matrix.
         distance_matrix : array
-            Matrix distance
+            Matrix distance, either square (n_samples, n_samples) or condensed
+            (n_samples*(n_samples-1)/2,) as returned by ``scipy.spatial.distance.pdist``.
         distance_thresold : int, float or False, optional (default=False).
             Distance(same unit of your distance_matrix).
             If False, will split spatially the dataset.
@@ -69,6 +71,10 @@ class distanceCV:
         self.name = 'SLOO'
 
         self.distance_matrix = distance_matrix
+        if self.distance_matrix.ndim == 1:
+            # number of samples from the length of the condensed matrix,
+            # raises a ValueError if the length is not a valid one
+            self._n_distance = num_obs_y(self.distance_matrix)
         self.distance_thresold = distance_thresold
         self.y = y
         self.iterPos = 0
@@ -110,6 +116,22 @@ class distanceCV:
         else:
             self.n_repeats = self.minEffectiveClass
 
+    def _distance_row(self, idx):
+        """
+        Return the distances from sample idx to every sample.
+        """
+        if self.distance_matrix.ndim == 2:
+            return self.distance_matrix[idx, :]
+
+        # index of pair (i,j), i < j, in the condensed upper triangle
+        n = self._n_distance
+        k = np.arange(n)
+        i, j = np.minimum(k, idx), np.maximum(k, idx)
+        row = self.distance_matrix[n * i - i * (i + 1) // 2 + j - i - 1]
+        row[idx] = 0
+
+        return row
+
     def __iter__(self):
         return self
 
@@ -166,7 +188,7 @@ class distanceCV:
                                       str(C))
                             standPos = np.argwhere(
                                 self.groups[self.ROI] == self.distance_label)[0][0]
-                            distanceROI = (self.distance_matrix[standPos, :])
+                            distanceROI = self._distance_row(standPos)
                             tmpValid = np.where(self.groups == self.groups[self.ROI])[
                                 0].astype(np.int64)
 
@@ -183,8 +205,7 @@ class distanceCV:
                         else:
 
                             # get line of distance for specific ROI
-                            distanceROI = (
-                                self.distance_matrix[self.ROI, :])[CT]
+                            distanceROI = self._distance_row(self.ROI)[CT]
                             if self.valid_size is False:
                                 tmpValid = np.array(
                                     [self.ROI], dtype=np.int64)
@@ -19,15 +19,114 @@ The :mod:`museotoolbox.processing` module gathers raster and vector tools.
 import os
 import numpy as np
 import tempfile
+from functools import lru_cache
 from psutil import virtual_memory
 
 # spatial libraries
 from osgeo import __version__ as osgeo_version
-from osgeo import gdal, ogr
+from osgeo import gdal, ogr, gdal_array
 from joblib import Parallel, delayed
 
 from ..internal_tools import ProgressBar, push_feedback
 
+# numba is optional, used to compute the nodata mask of each block
+try:
+    from numba import njit, prange
+    from numba.core.errors import NumbaError
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _nodata_mask_numba(arr, mask, nodata, has_nodata, has_mask):
+        invalid = np.zeros(arr.shape, dtype=np.bool_)
+        for i in prange(arr.shape[0]):
+            masked = has_mask and not mask[i]
+            for j in range(arr.shape[1]):
+                invalid[i, j] = masked or (
+                    has_nodata and arr[i, j] == nodata)
+        return invalid
+else:
+    _nodata_mask_numba = None
+
+
+def _nodata_mask(arr, mask=None, nodata=None):
+    """
+    Return where values are not available, according to a mask and a nodata value.
+
+    Parameters
+    -----------
+    arr : np.ndarray, shape [n_pixels, n_features] or [n_lines, n_columns, n_features].
+        The values.
+    mask : np.ndarray or None, optional (default=None).
+        Boolean array with the shape of arr without the last axis, False where pixels are masked.
+    nodata : int, float or None, optional (default=None).
+        The nodata value.
+
+    Returns
+    --------
+    invalid : np.ndarray
+        Boolean array with the shape of arr, True where values are not available.
+    """
+    if _nodata_mask_numba is not None and arr.ndim == 2:
+        # nodata in the dtype of arr, as a float would lose large integers
+        if nodata is None:
+            nodata_value = np.zeros(1, dtype=arr.dtype)[0]
+        else:
+            with np.errstate(over='ignore', invalid='ignore'):
+                nodata_value = np.array(nodata).astype(arr.dtype)[()]
+        # if nodata does not fit in the dtype, let numpy compare the values
+        if nodata is None or nodata_value == nodata:
+            has_mask = mask is not None
+            if not has_mask:
+                mask = np.empty(0, dtype=bool)
+            try:
+                return _nodata_mask_numba(arr, mask.reshape(-1), nodata_value,
+                                          nodata is not None, has_mask)
+            except NumbaError:
+                # dtype not supported by numba (bool, complex...)
+                pass
+
+    if nodata is not None:
+        invalid = arr == nodata
+    else:
+        invalid = np.zeros(arr.shape, dtype=bool)
+    if mask is not None:
+        invalid |= ~mask[..., np.newaxis]
+
+    return invalid
+
+
+_NP2GDAL_CONVERSION = {
+    "uint8": 1,
+    "int8": 3,
+    "uint16": 2,
+    "int16": 3,
+    "uint32": 4,
+    "int32": 5,
+    "float32": 6,
+    "float64": 7,
+    "complex64": 10,
+    "complex128": 11,
+    "int64": 5,
+    "uint64": 5
+}
+
+# uint8/uint16/int16/uint32/int32/float/double/cint16/cint32/cfloat/cdouble
+_GDAL2OTB_CONVERSION = [
+    'uint8',
+    'uint8',
+    'uint16',
+    'int16',
+    'uint32',
+    'int32',
+    'float',
+    'double',
+    'cint16',
+    'cint32',
+    'cfloat',
+    'cdouble']
+
 
 def image_mask_from_vector(
         in_vector, in_image, out_image, invert=False, gdt=gdal.GDT_Byte):
@@ -62,10 +161,10 @@ def get_gdt_from_minmax_values(max_value, min_value=0):
 
     Parameters
     ----------
-    max_value : int or float.
-        The maximum value needed.
-    min_value : int or float, optional (default=0).
-        The minimum value needed.
+    max_value : int, float or array-like.
+        The maximum value needed (the maximum of the array if array-like).
+    min_value : int, float or array-like, optional (default=0).
+        The minimum value needed (the minimum of the array if array-like).
 
     Returns
     -------
@@ -81,6 +180,13 @@ def get_gdt_from_minmax_values(max_value, min_value=0):
     >>> get_gdt_from_minmax_values(16,-260)
     3
     """
+    # python scalars can be cached, unlike lists or arrays
+    return _get_gdt_from_minmax_values(
+        np.amax(max_value).item(), np.amin(min_value).item())
+
+
+@lru_cache(maxsize=32, typed=True)
+def _get_gdt_from_minmax_values(max_value, min_value):
     max_abs_value = np.amax(np.abs([max_value, min_value]))
 
     # if values are int
@@ -135,7 +241,19 @@ def convert_dt(dt, to_otb_dt=False):
     >>> _convert_dt(numpyDT=np.array([],dtype=np.float64).dtype.name)
     7
     """
-    from osgeo import gdal_array
+    code, warning = _convert_dt_lookup(dt, to_otb_dt)
+    # warn at each call, only the lookup is cached
+    if warning:
+        push_feedback(warning)
+    return code
+
+
+@lru_cache(maxsize=32, typed=True)
+def _convert_dt_lookup(dt, to_otb_dt):
+    """
+    Return the converted datatype of :func:`convert_dt` and the warning to show, if any.
+    """
+    warning = None
     if isinstance(dt, int):
         is_gdal = True
     else:
@@ -144,35 +262,21 @@ def convert_dt(dt, to_otb_dt=False):
     if is_gdal is True:
         code = gdal_array.GDALTypeCodeToNumericTypeCode(dt)
     else:
-        NP2GDAL_CONVERSION = {
-            "uint8": 1,
-            "int8": 3,
-            "uint16": 2,
-            "int16": 3,
-            "uint32": 4,
-            "int32": 5,
-            "float32": 6,
-            "float64": 7,
-            "complex64": 10,
-            "complex128": 11,
-            "int64": 5,
-            "uint64": 5
-        }
         try:
-            code = NP2GDAL_CONVERSION[dt]
+            code = _NP2GDAL_CONVERSION[dt]
             if dt.endswith('int64'):
-                push_feedback(
-                    'Warning : Numpy type {} is not recognized by gdal. Will use int32 instead'.format(dt))
+                warning = 'Warning : Numpy type {} is not recognized by gdal. Will use int32 instead'.format(
+                    dt)
         except BaseException:
             code = 7
-            push_feedback(
-                'Warning : Numpy type {} is not recognized by gdal. Will use float64 instead'.format(dt))
+            warning = 'Warning : Numpy type {} is not recognized by gdal. Will use float64 instead'.format(
+                dt)
     if to_otb_dt:
         if is_gdal:
             code = _convert_gdal_to_otb_dt(dt)
         else:
             code = _convert_gdal_to_otb_dt(code)
-    return code
+    return code, warning
 
 
 def _convert_gdal_to_otb_dt(dt):
@@ -200,25 +304,10 @@ def _convert_gdal_to_otb_dt(dt):
     >>> _convert_gdal_to_otb_dt(gdal.GDT_CFloat64)
     'cdouble'
     """
-    # uint8/uint16/int16/uint32/int32/float/double/cint16/cint32/cfloat/cdouble
-    code = [
-        'uint8',
-        'uint8',
-        'uint16',
-        'int16',
-        'uint32',
-        'int32',
-        'float',
-        'double',
-        'cint16',
-        'cint32',
-        'cfloat',
-        'cdouble']
-
-    if dt > len(code):
+    if dt >= len(_GDAL2OTB_CONVERSION):
         otb_dt = ('cdouble')
     else:
-        otb_dt = code[dt]
+        otb_dt = _GDAL2OTB_CONVERSION[dt]
 
     return otb_dt
 
@@ -242,8 +331,9 @@ def extract_ROI(in_image, in_vector, *fields, **kwargs):
             If `get_pixel_position=True`, will return pixel position in the image for each point.
         - only_pixel_position : bool, optional (default=False).
             If `only_pixel_position=True`, with only return pixel position for each point.
-        - prefer_memory : bool, optional (default=False).
+        - prefer_memory : bool or None, optional (default=None).
             If `prefer_memory=False`, will write temporary raster on disk to extract ROI values.
+            If None, will keep the temporary raster in memory if it uses less than half of the available memory.
         - verbose : bool or int, optional (default=True).
             The higher is the int verbose, the more it will returns informations.
 
@@ -297,7 +387,7 @@ def extract_ROI(in_image, in_vector, *fields, **kwargs):
     if 'prefer_memory' in kwargs:
         prefer_memory = kwargs['prefer_memory']
     else:
-        prefer_memory = False
+        prefer_memory = None
     # Open Raster
     raster = gdal.Open(in_image, gdal.GA_ReadOnly)
     if raster is None:
@@ -307,10 +397,13 @@ def extract_ROI(in_image, in_vector, *fields, **kwargs):
 
     nFields = len(fields)
 
+    # opened once, shared with each field rasterization
+    source = ogr.Open(in_vector)
+
     if nFields == 0 or fields[0] == False:
         fields = [False]
+        np_dtypes = [np.int64]
     else:
-        source = ogr.Open(in_vector)
         layer = source.GetLayer()
         np_dtypes = []
         ldefn = layer.GetLayerDefn()
@@ -330,10 +423,14 @@ def extract_ROI(in_image, in_vector, *fields, **kwargs):
             fdefn = ldefn.GetFieldDefn(idx)
             fdefn_type = fdefn.type
             if fdefn_type < 4 or fdefn_type == 12:
-                if fdefn_type > 1 and fdefn_type != 12:
+                # keep the width of the field : 32 bits are enough for an
+                # OFTInteger field, real fields must not be truncated
+                if fdefn_type == ogr.OFTInteger64:
+                    np_dtype = np.int64
+                elif fdefn_type in (ogr.OFTReal, ogr.OFTRealList):
                     np_dtype = np.float64
                 else:
-                    np_dtype = np.int64
+                    np_dtype = np.int32
             else:
                 raise ValueError(
                     'Wrong type for field "{}" : {}. \nPlease use int or float.'.format(
@@ -341,24 +438,23 @@ def extract_ROI(in_image, in_vector, *fields, **kwargs):
                             fdefn.type)))
             np_dtypes.append(np_dtype)
 
+    # rasterized fields are stored as float64
+    if prefer_memory is None:
+        rois_size = raster.RasterXSize * raster.RasterYSize * 8 * len(fields)
+        prefer_memory = rois_size < virtual_memory().available / 2
+
     rois = []
     temps = []
     for field in fields:
         if prefer_memory:
-            raster_in_mem = True
             image_field = 'MEM'
-            data_src = rasterize(in_image, in_vector, field,
-                                 out_image=image_field, gdt=gdal.GDT_Float64)
-
         else:
-
-            raster_in_mem = False
             image_field = tempfile.mktemp('_roi.tif')
-            rasterize(in_image, in_vector, field,
-                      out_image=image_field, gdt=gdal.GDT_Float64)
-            data_src = gdal.Open(image_field, gdal.GA_ReadOnly)
             temps.append(image_field)
 
+        data_src = rasterize(raster, source, field,
+                             out_image=image_field, gdt=gdal.GDT_Float64)
+
         if data_src is None:
             raise Exception(
                 'A problem occured when rasterizing {} with field {}'.format(
@@ -384,21 +480,30 @@ def extract_ROI(in_image, in_vector, *fields, **kwargs):
 
     # ulx, xres, xskew, uly, yskew, yres = raster.GetGeoTransform()
 
-    if get_pixel_position is True or only_pixel_position is True:
-        coords = np.array([], dtype=np.int64).reshape(0, 2)
-
     xDataType = convert_dt(gdalDT)
 
-    # Read block data
-    X = np.array([], dtype=xDataType).reshape(0, d)
-    F = np.array([], dtype=np.int64).reshape(
-        0, nFields)  # now support multiple fields
+    # Read a full-width strip per row of blocks if it fits in 512Mo
+    # (one gdal call instead of one per block), else read block per block.
+    # Rasterized fields are stored as float64.
+    strip_size = nc * y_block_size * \
+        (np.dtype(xDataType).itemsize * d + 8 * len(rois))
+    if strip_size <= 536870912:
+        x_block_size = nc
+
+    # Store each block and concatenate once at the end
+    # (growing arrays block per block copies the whole buffer each time)
+    X_list = []
+    F_lists = [[] for f in range(nFields)]  # now support multiple fields
+    coords_list = []
 
     # for progress bar
     if verbose:
         total = 100
         pb = ProgressBar(total, message='Reading raster values... ')
 
+    # band of each rasterized field, fetched once
+    roi_bands = [roi.GetRasterBand(1) for roi in rois]
+
     for i in range(0, nl, y_block_size):
         if i + y_block_size < nl:  # Check for size consistency in Y
             lines = y_block_size
@@ -416,59 +521,69 @@ def extract_ROI(in_image, in_vector, *fields, **kwargs):
                 pb.add_position(currentPosition)
             # Load the reference data
 
-            ROI = rois[0].GetRasterBand(1).ReadAsArray(j, i, cols, lines)
+            ROI = roi_bands[0].ReadAsArray(j, i, cols, lines)
 
             t = np.nonzero(ROI)
 
             if t[0].size > 0:
                 if get_pixel_position or only_pixel_position:
-                    coordsTp = np.empty((t[0].shape[0], 2))
-
-                    coordsTp[:, 0] = t[1] + j
-                    coordsTp[:, 1] = t[0] + i
-
-                    coords = np.concatenate((coords, coordsTp))
+                    # pixel positions (x, y) fit in int32
+                    coords_list.append(np.stack(
+                        (t[1] + j, t[0] + i), axis=1).astype(np.int32, copy=False))
 
                 # Load the Variables
                 if not only_pixel_position:
                     # extract values from each field
                     if nFields > 0:
-                        Ftemp = np.empty(
-                            (t[0].shape[0], nFields), dtype=np.int64)
-                        for idx, roiTemp in enumerate(rois):
-                            roiField = roiTemp.GetRasterBand(
-                                1).ReadAsArray(j, i, cols, lines)
-                            Ftemp[:, idx] = roiField[t]
-
-                        F = np.concatenate((F, Ftemp))
-
-                    # extract raster values (X)
-                    Xtp = np.empty((t[0].shape[0], d), dtype=xDataType)
-                    for k in range(d):
-                        band = raster.GetRasterBand(
-                            k + 1).ReadAsArray(j, i, cols, lines)
-                        Xtp[:, k] = band[t]
+                        # first field is already read as ROI
+                        F_lists[0].append(
+                            ROI[t].astype(np_dtypes[0], copy=False))
+                        for idx in range(1, nFields):
+                            roiField = roi_bands[idx].ReadAsArray(
+                                j, i, cols, lines)
+                            F_lists[idx].append(
+                                roiField[t].astype(np_dtypes[idx], copy=False))
+
+                    # extract raster values (X), all bands in one read
+                    block = raster.ReadAsArray(j, i, cols, lines)
+                    if d == 1:
+                        Xtp = block[t].reshape(-1, 1)
+                    else:
+                        Xtp = block[:, t[0], t[1]].T
 
-                    X = np.concatenate((X, Xtp))
+                    X_list.append(Xtp)
 
     if verbose:
         pb.add_position(100)
+
+    if X_list:
+        X = np.concatenate(X_list, axis=0)
+    else:
+        X = np.empty((0, d), dtype=xDataType)
+    F = []
+    for idx, F_list in enumerate(F_lists):
+        if F_list:
+            F.append(np.concatenate(F_list, axis=0))
+        else:
+            F.append(np.empty(0, dtype=np_dtypes[idx]))
+    if coords_list:
+        coords = np.concatenate(coords_list, axis=0)
+    else:
+        coords = np.empty((0, 2), dtype=np.int32)
     # Clean/Close variables
-    # del Xtp,band
-    roi = None  # Close the roi file
+    roi_bands, rois, data_src = None, None, None  # Close the roi files
     raster = None  # Close the raster file
 
     # remove temp raster
-    if raster_in_mem:
-        for roi in temps:
-            os.remove(roi)
+    for roi in temps:
+        os.remove(roi)
 
     # generate returns
     if only_pixel_position:
         toReturn = coords
     else:
         if nFields > 0:
-            toReturn = [X] + [F[:, f] for f in range(nFields)]
+            toReturn = [X] + F
         else:
             toReturn = X
 
@@ -488,10 +603,10 @@ def rasterize(in_image, in_vector, in_field=False, out_image='MEM',
 
     Parameters
     -----------
-    in_image : str.
-        A filename or path corresponding to a raster image.
-    in_vector : str.
-        A filename or path corresponding to a vector file.
+    in_image : str, path-like or gdal.Dataset.
+        A filename or path corresponding to a raster image, or the already opened raster.
+    in_vector : str, path-like or ogr.DataSource.
+        A filename or path corresponding to a vector file, or the already opened vector.
     in_field : str, optional (default=False).
         Name of the filed to rasteirze.
         If False, will rasterize the polygons or points with >0 value, and set the other values to 0.
@@ -509,11 +624,18 @@ def rasterize(in_image, in_vector, in_field=False, out_image='MEM',
          The open dataset with gdal (essential if out_image is set to 'MEM')
     """
 
-    data_src = gdal.Open(in_image)
-    shp = ogr.Open(in_vector)
+    if isinstance(in_image, gdal.Dataset):
+        data_src = in_image
+    else:
+        data_src = gdal.Open(os.fspath(in_image))
+    if isinstance(in_vector, ogr.DataSource):
+        shp = in_vector
+    else:
+        shp = ogr.Open(os.fspath(in_vector))
 
     lyr = shp.GetLayer()
 
+    out_image = os.fspath(out_image)
     if out_image.upper() == 'MEM':
 
         driver = gdal.GetDriverByName('MEM')
@@ -535,16 +657,17 @@ def rasterize(in_image, in_vector, in_field=False, out_image='MEM',
     dst_ds.SetProjection(data_src.GetProjection())
 
     if in_field is False or in_field is None:
+        #            gdal.Rasterize(dst_ds, vectorSrc)
+        gdal.RasterizeLayer(dst_ds, [1], lyr, options=options)
         if invert:
-            try:
-                options = gdal.RasterizeOptions(inverse=invert)
-                gdal.Rasterize(dst_ds, in_vector, options=options)
-            except BaseException:
-                raise Exception(
-                    'Version of gdal is too old : RasterizeOptions is not available.\nPlease update.')
-        else:
-            #            gdal.Rasterize(dst_ds, vectorSrc)
-            gdal.RasterizeLayer(dst_ds, [1], lyr, options=options)
+            # burn outside the polygons instead, from the opened layer
+            # (the vector may not be reopened by its name if in memory)
+            band = dst_ds.GetRasterBand(1)
+            n_lines = max(1, 16777216 // dst_ds.RasterXSize)
+            for row in range(0, dst_ds.RasterYSize, n_lines):
+                height = min(n_lines, dst_ds.RasterYSize - row)
+                burned = band.ReadAsArray(0, row, dst_ds.RasterXSize, height)
+                band.WriteArray((burned == 0) * np.uint8(255), 0, row)
 
         dst_ds.GetRasterBand(1).SetNoDataValue(0)
     else:
@@ -665,6 +788,7 @@ class RasterMath:
             if self.opened_mask is None:
                 raise ReferenceError(
                     'Impossible to open image ' + in_image_mask)
+            self._mask_band = self.opened_mask.GetRasterBand(1)
 
         # Initialize the output
         self.lastProgress = 0
@@ -907,7 +1031,9 @@ class RasterMath:
         dst_ds.SetGeoTransform(self.geo_transform)
         dst_ds.SetProjection(self.projection)
 
-        self._outputs.append(dict(gdal_object=dst_ds))
+        # bands are fetched once to write every block
+        self._outputs.append(dict(gdal_object=dst_ds, gdal_bands=[
+            dst_ds.GetRasterBand(ind + 1) for ind in range(out_n_bands)]))
 
     def _iter_block(self, get_block=False,
                     y_block_size=False, x_block_size=False):
@@ -928,7 +1054,8 @@ class RasterMath:
                 else:
                     yield col, row, width, height
 
-    def _generate_block_array(self, col, row, width, height, mask=False):
+    def _generate_block_array(self, col, row, width, height, mask=False,
+                              arr_mask=None):
         """
         Return block according to position and width/height of the raster.
 
@@ -944,29 +1071,26 @@ class RasterMath:
             the height.
         mask : bool.
             Use the mask (only if a mask if given in parameter of `RasterMath`.)
+        arr_mask : np.ndarray or None, optional (default=None).
+            The mask of the block if already read, then used instead of reading it again.
 
         Returns
         -------
         arr : numpy array with masked values. (`np.ma.masked_array`)
         """
         arrs = []
-        if mask:
-            bandMask = self.opened_mask.GetRasterBand(1)
-            arrMask = bandMask.ReadAsArray(
-                col, row, width, height).astype(np.bool)
+        if arr_mask is not None or mask:
+            if arr_mask is None:
+                arrMask = self._read_mask(col, row, width, height)
+            else:
+                arrMask = arr_mask
             if self.return_3d is False:
                 arrMask = arrMask.reshape(width * height)
         else:
             arrMask = None
 
         for nRaster in range(len(self.opened_images)):
-            nb = self.opened_images[nRaster].RasterCount
-
-            if self.return_3d:
-                arr = np.empty((height, width, nb), dtype=self.dtype_np)
-            else:
-                arr = np.empty((height * width, nb), dtype=self.dtype_np)
-#            for ind in range(nb):
+            # read all bands in one call, shape (nb, height, width)
             arr = self.opened_images[nRaster].ReadAsArray(
                 col, row, width, height)
             if arr.ndim > 2:
@@ -986,46 +1110,60 @@ class RasterMath:
 
         return arrs
 
+    def _read_mask(self, col, row, width, height):
+        """
+        Read the mask of a block as a boolean array, False where pixels are masked.
+
+        The mask is only used to filter the block, so blocks up to the
+        block size are read in buffers reused from one block to another.
+        """
+        bandMask = self._mask_band
+        size = width * height
+
+        if size > self.size:
+            return bandMask.ReadAsArray(
+                col, row, width, height).astype(bool)
+
+        if self._mask_buffers is None:
+            self._mask_buffers = (
+                np.empty(self.size, dtype=convert_dt(bandMask.DataType)),
+                np.empty(self.size, dtype=bool))
+        raw, arrMask = [buf[:size].reshape(height, width)
+                        for buf in self._mask_buffers]
+
+        bandMask.ReadAsArray(col, row, width, height, buf_obj=raw)
+        return np.not_equal(raw, 0, out=arrMask)
+
+    def _read_block_mask(self, idx_block):
+        """
+        Return a copy of the mask of a block, True where pixels are not masked.
+        """
+        col, row, width, height = self.get_block_coords(idx_block)
+        # copy, as _read_mask fills the same buffer at each call
+        return self._read_mask(col, row, width, height).copy()
+
+    def _read_block(self, idx_block, arr_mask=None):
+        """
+        Return a block as a masked array, using its mask if already read.
+        """
+        col, row, width, height = self.get_block_coords(idx_block)
+        return self._generate_block_array(
+            col, row, width, height, self.mask, arr_mask)
+
     def _filter_nodata(self, arr, mask=None):
         """
         Filter no data according to a mask and to nodata value set in the raster.
         """
         arr = self.reshape_ndim(arr)
-        if mask is not None:
-            mask = self.reshape_ndim(mask)
-            
-        arr_to_check = np.copy(arr)           
-        arr_shape = arr.shape
-        
-        out_arr = np.zeros((arr_shape), dtype=self.dtype_np)
-        if self.nodata:
-            out_arr[:] = self.nodata
 
-        if self.mask:
-            t = np.logical_or((mask == False),
-                              arr_to_check == self.nodata)
-        else:
-            t = np.where(arr_to_check == self.nodata)
-        
-        
-        if self.return_3d:
-            if arr.ndim == 2:
-                arr = np.expand_dims(arr, 2)
-            tmp_mask = np.zeros(arr_shape[:2], dtype=bool)
-            if self.mask:
-                t = t[...,0]
-            else:
-                t = t[:2]
-            tmp_mask[t] = True
-            tmp_mask  = np.repeat(tmp_mask.reshape(
-                *tmp_mask.shape, 1), arr.shape[-1], axis=2)
-            out_arr = np.ma.masked_array(arr, tmp_mask)
-        else:
-            tmp_mask = np.zeros(arr_shape, dtype=bool)
-            tmp_mask[t, ...] = True
-            out_arr = np.ma.masked_array(arr, tmp_mask)
+        # one boolean pass, True where the value is not available
+        invalid = _nodata_mask(arr, mask, self.nodata)
+
+        # a pixel with nodata in one band is masked in every band
+        tmp_mask = np.any(invalid, axis=-1, keepdims=True)
+        tmp_mask = np.repeat(tmp_mask, arr.shape[-1], axis=-1)
 
-        return out_arr
+        return np.ma.masked_array(arr, tmp_mask)
     
     def get_image_as_array(self):
         """
@@ -1067,34 +1205,20 @@ class RasterMath:
         Block : np.ndarray or np.ma.MaskedArray
         """
 
-        if block_number > self.n_blocks:
-            raise ValueError(
-                'There are only {} blocks in your image.'.format(
-                    self.n_blocks))
-        else:
-
-            row = [l for l in range(0, self.n_lines, self.y_block_size)]
-            col = [c for c in range(0, self.n_columns, self.x_block_size)]
+        col, row, width, height = self.get_block_coords(block_number)
 
-            row_number = int(block_number / self.n_x_blocks)
-            col_number = int(block_number % self.n_x_blocks)
+        tmp = self._generate_block_array(
+            col, row, width, height, self.mask)
 
-            width = min(self.n_columns - col[col_number], self.x_block_size)
-            height = min(self.n_lines - row[row_number], self.y_block_size)
-
-            tmp = self._generate_block_array(
-                col[col_number], row[row_number], width, height, self.mask)
-
-            # return only available pixels when user ask and it is 2d
-            if return_with_mask is False and self.return_3d is False:
-                if len(self.opened_images) > 1:
-                    tmp = [np.ma.copy(t) for t in tmp]
-                    tmp = [t.data for t in tmp]
-                else:
-                    tmp = np.ma.copy(tmp)
-                    tmp = tmp.data
+        # return only available pixels when user ask and it is 2d
+        # (the block is freshly read, no need to copy it)
+        if return_with_mask is False and self.return_3d is False:
+            if len(self.opened_images) > 1:
+                tmp = [t.data for t in tmp]
+            else:
+                tmp = tmp.data
 
-            return tmp
+        return tmp
 
     def get_block_coords(self, block_number=0):
         """
@@ -1112,22 +1236,20 @@ class RasterMath:
         List of positions of the block [x,y,width,height]
 
         """
-        if block_number > self.n_blocks:
+        if block_number >= self.n_blocks:
             raise ValueError(
                 'There are only {} blocks in your image.'.format(
                     self.n_blocks))
         else:
+            # python int, as gdal does not take numpy integers as offsets
+            block_number = int(block_number)
+            row = (block_number // self.n_x_blocks) * self.y_block_size
+            col = (block_number % self.n_x_blocks) * self.x_block_size
 
-            row = [l for l in range(0, self.n_lines, self.y_block_size)]
-            col = [c for c in range(0, self.n_columns, self.x_block_size)]
-
-            row_number = int(block_number / self.n_x_blocks)
-            col_number = int(block_number % self.n_x_blocks)
+            width = min(self.n_columns - col, self.x_block_size)
+            height = min(self.n_lines - row, self.y_block_size)
 
-            width = min(self.n_columns - col[col_number], self.x_block_size)
-            height = min(self.n_lines - row[row_number], self.y_block_size)
-
-            return [col[col_number], row[row_number], width, height]
+            return [col, row, width, height]
 
     def _manage_block_mask(self, block):
 
@@ -1137,14 +1259,14 @@ class RasterMath:
             mask_block = block.mask
 
         # if everything is masked
-        if np.all(mask_block):
+        if mask_block.all():
             size = 0
         # if everything is not masked
-        elif np.all(mask_block == False):
+        elif not mask_block.any():
             size = 1
 
         # if part masked, part unmasked
-        elif np.any(mask_block == False):
+        else:
             size = 1
 
             if self.return_3d:
@@ -1170,48 +1292,32 @@ class RasterMath:
             If int, random_state is the seed used by the random number generator.
             If None, the random number generator is the RandomState instance used by numpy np.random.
         """
-#        mask = np.array([True])
-
         np.random.seed(random_state)
-        rdm = np.random.permutation(np.arange(self.n_blocks))
-        idx = 0
-        size = 0
 
-        while size == 0:
-            tmp = self.get_block(block_number=rdm[idx], return_with_mask=True)
+        # draw a few blocks, then look at every block from the last drawn one
+        # if they were all fully masked
+        block_numbers = np.random.randint(0, self.n_blocks, 8)
+        start = block_numbers[-1]
+
+        for idx in range(block_numbers.size + self.n_blocks):
+            if idx < block_numbers.size:
+                block_number = block_numbers[idx]
+            else:
+                block_number = (start + idx - block_numbers.size) % self.n_blocks
+
+            tmp = self.get_block(block_number=block_number,
+                                 return_with_mask=True)
 
             if isinstance(tmp, list):
                 mask_block = tmp[0].mask
             else:
                 mask_block = tmp.mask
 
-            # if everything is masked
-            if np.all(mask_block):
-                size = 0
-            # if everything is not masked
-            elif np.all(mask_block == False):
-                size = 1
-                tmp = tmp
-
-            # if part masked, part unmasked
-            elif np.any(mask_block == False):
-                size = 1
-
-                if self.return_3d:
-                    if mask_block.ndim > 2:
-                        mask = mask_block[..., 0]
-
-                elif mask_block.ndim == 1:
-                    mask = mask_block
-                else:
-                    mask = mask_block[..., 0]
-
-                if isinstance(tmp, list) and self.return_3d is False:
-                    tmp = [b[~mask, ...].data for b in tmp]
+            # if everything is masked, try another block
+            if not mask_block.all():
+                return self._manage_block_mask(tmp)
 
-            idx += 1
-
-        return tmp
+        raise ValueError('Every block of the image is masked.')
 
     def reshape_ndim(self, x):
         """
@@ -1238,19 +1344,20 @@ class RasterMath:
         """
         Yields each whole band as np masked array (so with masked data)
         """
+        # the mask is the same for every band
+        if self.mask:
+            mask = ~np.asarray(
+                self._mask_band.ReadAsArray(), dtype=bool)
+
         for nRaster in range(len(self.opened_images)):
             nb = self.opened_images[nRaster].RasterCount
             for n in range(1, nb + 1):
                 band = self.opened_images[nRaster].GetRasterBand(n)
                 band = band.ReadAsArray()
                 if self.mask:
-                    mask = np.asarray(
-                        self.opened_mask.GetRasterBand(1).ReadAsArray(), dtype=bool)
-                    band = np.ma.MaskedArray(band, mask=~mask)
+                    band = np.ma.MaskedArray(band, mask=mask)
                 else:
-                    band = np.ma.MaskedArray(
-                        band, mask=np.where(
-                            band == self.nodata, True, False))
+                    band = np.ma.MaskedArray(band, mask=band == self.nodata)
 
                 yield band
 
@@ -1301,17 +1408,15 @@ class RasterMath:
         if self.y_block_size == -1:
             self.y_block_size = self.n_lines
             
-        self.n_blocks = np.ceil(self.n_lines / self.y_block_size).astype(
-            int) * np.ceil(self.n_columns / self.x_block_size).astype(int)
+        self.n_y_blocks = int(np.ceil(self.n_lines / self.y_block_size))
+        self.n_x_blocks = int(np.ceil(self.n_columns / self.x_block_size))
+        self.n_blocks = self.n_y_blocks * self.n_x_blocks
         self.block_sizes = [self.x_block_size, self.y_block_size]
 
-        self.n_y_blocks = len(
-            [i for i in range(0, self.n_lines, self.y_block_size)])
-        self.n_x_blocks = len(
-            [i for i in range(0, self.n_columns, self.x_block_size)])
-
         # to compute memory size needed in run
         self.size = self.y_block_size * self.x_block_size
+        # buffers to read the mask, allocated at the new block size
+        self._mask_buffers = None
         if self.verbose:
             push_feedback('Total number of blocks : %s' % self.n_blocks)
 
@@ -1355,15 +1460,15 @@ class RasterMath:
             mask_block = block.mask
 
         # if everything is masked
-        if np.all(mask_block):
+        if mask_block.all():
             mask = True
             out_block = nodata
         # if everything is not masked
-        elif np.all(mask_block == False):
+        elif not mask_block.any():
             mask = False
 
         # if part masked, part unmasked
-        elif np.any(mask_block == False):
+        else:
             tmp_arr = mask_block.size
             if return_3d:
                 if mask_block.ndim > 2:
@@ -1497,6 +1602,37 @@ class RasterMath:
             self.pb = ProgressBar(self.n_blocks, message=self.message)
             self._position = 0
 
+        # keep the same pool of workers alive for every batch and output,
+        # blocks are written back only by this process (gdal is not
+        # thread-safe for writing)
+        if self.n_jobs > 1:
+            with Parallel(self.n_jobs) as parallel:
+                self._run_batches(length, parallel)
+        else:
+            self._run_batches(length)
+
+        # delete output gdal object
+        for fun in self._outputs:
+            if fun['nodata'] is not False:
+                fun['gdal_bands'][0].SetNoDataValue(fun['nodata'])
+            fun['gdal_bands'] = None
+            fun['gdal_object'] = None
+
+        # no more thing to do
+        if self.verbose:
+            self.pb.add_position(self.n_blocks)
+
+    def _run_batches(self, length, parallel=None):
+        """
+        Compute and write every output, batch of blocks per batch of blocks.
+
+        Parameters
+        ----------
+        length : int
+            Number of blocks per batch.
+        parallel : joblib.Parallel or None, optional (default=None).
+            If given, the already opened pool used to process the blocks.
+        """
         for i in range(0, self.n_blocks, length):
 
             if i <= self.n_blocks - length:
@@ -1504,42 +1640,48 @@ class RasterMath:
             else:
                 idx_blocks = np.arange(i, self.n_blocks)
 
+            # the mask of each block is read once for every output,
+            # blocks fully masked by the mask are neither read nor computed
+            if self.mask:
+                masks = [self._read_block_mask(idx_block)
+                         for idx_block in idx_blocks]
+                is_masked = [not arr_mask.any() for arr_mask in masks]
+            else:
+                masks = [None] * len(idx_blocks)
+                is_masked = [False] * len(idx_blocks)
+            to_process = [(idx_block, arr_mask) for idx_block, arr_mask, masked
+                          in zip(idx_blocks, masks, is_masked) if not masked]
+
             for idx_output, output in enumerate(self._outputs):
 
                 function = output['function']
                 kwargs = output['kwargs']
 
-                if self.n_jobs > 1:
-                    res = Parallel(
-                        self.n_jobs)(
+                if parallel is not None:
+                    res = parallel(
                         delayed(
                             self._process_block)(
                             function,
                             kwargs,
-                            self.get_block(
-                                idx_block,
-                                return_with_mask=True),
+                            self._read_block(idx_block, arr_mask),
                             output['n_bands'],
                             output['nodata'],
                             output['np_type'],
                             self.return_3d,
-                            idx_block) for idx,
-                        idx_block in enumerate(idx_blocks))
+                            idx_block) for idx_block, arr_mask in to_process)
                     if self.verbose:
-                        self._position += total / len(self._outputs)
+                        self._position += len(idx_blocks) / len(self._outputs)
                         self.pb.add_position(self._position)
 
                 else:
                     res = []
-                    for idx, idx_block in enumerate(idx_blocks):
+                    for idx_block, arr_mask in to_process:
 
                         res.append(
                             self._process_block(
                                 function,
                                 kwargs,
-                                self.get_block(
-                                    idx_block,
-                                    return_with_mask=True),
+                                self._read_block(idx_block, arr_mask),
                                 output['n_bands'],
                                 output['nodata'],
                                 output['np_type'],
@@ -1549,22 +1691,19 @@ class RasterMath:
                             self._position += 1 / len(self._outputs)
                             self.pb.add_position(self._position)
 
-                for idx_block, block in enumerate(res):
-                    self.write_block(block, idx_blocks[idx_block], idx_output)
-
-                self._outputs[idx_output]['gdal_object'].FlushCache()
-
-        # delete output gdal object
-        for fun in self._outputs:
-            if fun['nodata'] is not False:
-                band = fun['gdal_object'].GetRasterBand(1)
-                band.SetNoDataValue(fun['nodata'])
-                band.FlushCache()
-            fun['gdal_object'] = None
+                    if self.verbose and len(to_process) < len(idx_blocks):
+                        self._position += (len(idx_blocks) -
+                                           len(to_process)) / len(self._outputs)
+                        self.pb.add_position(self._position)
 
-        # no more thing to do
-        if self.verbose:
-            self.pb.add_position(self.n_blocks)
+                # outputs are flushed once, when closed at the end of run
+                res = iter(res)
+                for idx_block, masked in zip(idx_blocks, is_masked):
+                    if masked:
+                        block = output['nodata']
+                    else:
+                        block = next(res)
+                    self.write_block(block, idx_block, idx_output)
 
     def write_block(self, block, idx_block, idx_func):
         """
@@ -1585,20 +1724,29 @@ class RasterMath:
         """
 
         coords = self.get_block_coords(idx_block)
-        for ind in range(self._outputs[idx_func]['n_bands']):
-            # write result band per band
-            indGdal = ind + 1
+        output = self._outputs[idx_func]
+
+        # if int or float value, write it in each pixel of the block
+        # (same array for every band and block size, in the output datatype)
+        if isinstance(block, (float, int)):
+            fill = output.get('fill_block')
+            if fill is None or fill.shape != (coords[3], coords[2]) or \
+                    fill[0, 0] != block:
+                fill = np.full((coords[3], coords[2]), block,
+                               dtype=output['np_type'])
+                output['fill_block'] = fill
+        else:
+            # to be sure to have 2 or 3 dim
+            block = self.reshape_ndim(block)
 
-            curBand = self._outputs[idx_func]['gdal_object'].GetRasterBand(
-                indGdal)
+        for ind, curBand in enumerate(output['gdal_bands']):
+            # write result band per band
 
-            # if int or float value, write it in each pixel of the block
             if isinstance(block, (float, int)):
-                resToWrite = np.full((coords[3], coords[2]), block)
+                resToWrite = fill
 
             else:
-                # to be sure to have 2 or 3 dim
-                resToWrite = self.reshape_ndim(block)[..., ind]
+                resToWrite = block[..., ind]
                 if resToWrite.ndim <= 1:
                     resToWrite = self.reshape_ndim(
                         resToWrite).reshape(coords[3], coords[2])
@@ -1873,7 +2021,59 @@ class _create_point_layer:
         self.outData.Destroy()
 
 
-def get_distance_matrix(in_image, in_vector, field=False, verbose=False):
+def _tiled_distance_matrix(coords, tile=512, dtype=np.uint64):
+    """
+    Euclidean distance matrix of coords, computed tile per tile.
+
+    Only the upper triangle tiles are computed, then mirrored, so no full
+    float64 matrix is allocated before the cast to dtype.
+    If the matrix would take more than a quarter of the available memory,
+    it is mapped to a temporary file and paged by the system.
+    """
+    from scipy.spatial import distance
+
+    n = coords.shape[0]
+    if n * n * np.dtype(dtype).itemsize > virtual_memory().available / 4:
+        # file is unlinked by the system once the map is released
+        distance_matrix = np.memmap(
+            tempfile.TemporaryFile(), dtype=dtype, mode='w+', shape=(n, n))
+    else:
+        distance_matrix = np.empty((n, n), dtype=dtype)
+    for i in range(0, n, tile):
+        for j in range(i, n, tile):
+            block = distance.cdist(
+                coords[i:i + tile], coords[j:j + tile], 'euclidean')
+            distance_matrix[i:i + tile, j:j + tile] = block
+            distance_matrix[j:j + tile, i:i + tile] = block.T
+
+    return distance_matrix
+
+
+def get_distance_matrix_from_coords(coords, dtype=np.uint64):
+    """
+    Return the distance one-to-one between pixel positions already extracted,
+    e.g. with ``extract_ROI(in_image, in_vector, get_pixel_position=True)``.
+
+    Parameters
+    ----------
+    coords : array of shape (nSamples,2)
+        Position of each pixel.
+    dtype : numpy datatype, optional (default=np.uint64).
+        Datatype of the distance matrix. With an integer datatype, distances are truncated to the pixel.
+
+    Returns
+    --------
+    distance_matrix : array of shape (nSamples,nSamples)
+
+    See also
+    ---------
+    museotoolbox.processing.get_distance_matrix : to extract the positions and get the distance matrix.
+    """
+    return _tiled_distance_matrix(coords, dtype=dtype)
+
+
+def get_distance_matrix(in_image, in_vector, field=False, verbose=False,
+                        dtype=np.uint64):
     """
     Return for each pixel, the distance one-to-one to the other pixels listed in the vector.
 
@@ -1885,6 +2085,8 @@ def get_distance_matrix(in_image, in_vector, field=False, verbose=False):
         Path of the vector file to rasterize.
     field : str or False, optional (default=False).
         Name of the vector field to extract the value (must be float or integer).
+    dtype : numpy datatype, optional (default=np.uint64).
+        Datatype of the distance matrix. With an integer datatype, distances are truncated to the pixel.
 
     Returns
     --------
@@ -1903,13 +2105,11 @@ def get_distance_matrix(in_image, in_vector, field=False, verbose=False):
         get_pixel_position=True,
         only_pixel_position=only_pixel_position,
         verbose=verbose)
-    from scipy.spatial import distance
     if field:
         label = coords[1]
         coords = coords[2]
 
-    distance_matrix = np.asarray(distance.cdist(
-        coords, coords, 'euclidean'), dtype=np.uint64)
+    distance_matrix = get_distance_matrix_from_coords(coords, dtype=dtype)
 
     if field:
         return distance_matrix, label
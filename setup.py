@@ -41,6 +41,7 @@ setuptools.setup(
                       'matplotlib',
                       'joblib',
                       'psutil'],
+    extras_require={'numba': ['numba']},
     packages=setuptools.find_packages(),
     classifiers=[
             "Topic :: Scientific/Engineering :: Artificial Intelligence",
@@ -3,6 +3,7 @@ import unittest
 
 import numpy as np
 from museotoolbox import ai
+from museotoolbox.cross_validation import RandomStratifiedKFold
 from museotoolbox.datasets import load_historical_data
 from museotoolbox.processing import image_mask_from_vector
 from osgeo import gdal
@@ -68,6 +69,25 @@ class TestStats(unittest.TestCase):
         with self.assertRaises(ValueError):
             model.fit(X,y,cv=False)
         
+    def test_cache_dir(self):
+        cache_dir = tempfile.mkdtemp()
+        # removed even if an assertion fails
+        self.addCleanup(shutil.rmtree,cache_dir,ignore_errors=True)
+        cms = []
+        n_cached = []
+        for run in range(2):
+            cv = RandomStratifiedKFold(n_splits=2,random_state=12)
+            model = ai.SuperLearner(RandomForestClassifier(random_state=12),param_grid=param_grid,n_jobs=1,cache_dir=cache_dir)
+            model.fit(X,y,cv=cv)
+            cms.append([stats['confusion_matrix'] for stats in model.get_stats_from_cv()])
+            n_cached.append(sum('output.pkl' in files for root,dirs,files in os.walk(cache_dir)))
+        
+        # each fold is stored on the first run, and only read on the second one
+        assert(n_cached[0] == n_cached[1] == 2)
+        assert(len(cms[0]) == len(cms[1]) == 2)
+        for cm,cm_cached in zip(*cms):
+            assert(np.array_equal(cm,cm_cached))
+        
     def test_sequential(self):
         
         sfs = ai.SequentialFeatureSelection(classifier,param_grid)
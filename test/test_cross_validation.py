@@ -8,18 +8,113 @@ Created on Sun Nov 24 12:03:31 2019
 # -*- coding: utf-8 -*-
 import unittest
 import os
+import tempfile
+import shutil
 import numpy as np
+import pytest
+from scipy.spatial.distance import squareform, num_obs_y
 
 from museotoolbox.datasets import load_historical_data
 from museotoolbox import cross_validation
 from museotoolbox import processing
 
 raster,vector = load_historical_data()
-X,y,g = load_historical_data(return_X_y_g=True)
-distance_matrix = processing.get_distance_matrix(raster,vector)
-n_class = len(np.unique(y,return_counts=True)[1])
-smallest_class = np.min(np.unique(y,return_counts=True)[1])
+# samples, labels, groups and pixel positions from a single extraction
+X,y,g,coords = processing.extract_ROI(raster,vector,'Class','uniquefid',get_pixel_position=True)
+y = y.astype(np.int32,copy=False) # only 5 classes
+# distances are only compared to thresholds, float32 halves the matrix size
+distance_matrix = processing.get_distance_matrix_from_coords(coords,dtype=np.float32)
+# condensed upper triangle (as scipy pdist), also accepted by the spatial CVs
+distance_matrix_condensed = squareform(distance_matrix,checks=False)
+_labels, _counts = np.unique(y,return_counts=True)
+n_class = _counts.size
+smallest_class = _counts.min()
 
+# numba is optional, used to count labels of a fold without gathering them
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(cache=True)
+    def _count_distinct(labels, idx, k):
+        seen = np.zeros(k, np.uint8)
+        count = 0
+        for i in range(idx.size):
+            label = labels[idx[i]]
+            if not seen[label]:
+                seen[label] = 1
+                count += 1
+        return count
+
+def _n_distinct(labels, idx):
+    # number of distinct labels[idx] in one linear pass (labels are positive integers, at most _labels[-1])
+    if njit is not None:
+        return _count_distinct(labels, idx, _labels[-1]+1)
+    return np.count_nonzero(np.bincount(labels[idx]))
+
+
+
+def setUpModule():
+    # one pixel per sample, extracted once and shared by every test saving folds to vector
+    global tempdir, pixels
+    tempdir = tempfile.mkdtemp(prefix='mtb_cv_')
+    pixels = os.path.join(tempdir,'pixels.gpkg')
+    processing.sample_extraction(raster,vector,out_vector=pixels,verbose=False)
+
+def tearDownModule():
+    shutil.rmtree(tempdir,ignore_errors=True)
+
+# one test per configuration, so pytest (and pytest-xdist) can run them apart
+@pytest.mark.parametrize('split',[False,1,2,5])
+def test_loo(split):
+    # one sample per class in validation
+    expected_vl = n_class
+    expected_tr = y.size-expected_vl
+    
+    cv = cross_validation.LeaveOneOut(n_repeats=split,random_state=split,verbose=split)
+    if split == False:
+        assert(cv.get_n_splits(X,y)==smallest_class)
+    else:
+        assert(cv.get_n_splits(X,y)==split)
+    assert(cv.verbose == split)
+    
+    splits = list(cv.split(X,y))
+    tr_sizes = np.fromiter((tr.size for tr,vl in splits),dtype=np.intp)
+    vl_sizes = np.fromiter((vl.size for tr,vl in splits),dtype=np.intp)
+    assert(np.all(tr_sizes == expected_tr))
+    assert(np.all(vl_sizes == expected_vl))
+
+def test_kfold_valid_size():
+    cv = cross_validation.RandomStratifiedKFold(valid_size=1/50)
+    with pytest.raises(ValueError):
+        cv.get_n_splits(X,y)
+
+@pytest.mark.parametrize('split',[1,2,5])
+def test_kfold(split):
+    expected_n_splits = split*split+split
+    cv = cross_validation.RandomStratifiedKFold(n_splits=1+split,n_repeats=split,verbose=split)
+    assert(cv.get_n_splits(X,y)==expected_n_splits)
+    assert(cv.verbose == split)
+    
+    splits = list(cv.split(X,y))
+    assert(len(splits) == expected_n_splits)
+    tr_sizes = np.fromiter((tr.size for tr,vl in splits),dtype=np.intp,count=expected_n_splits)
+    vl_sizes = np.fromiter((vl.size for tr,vl in splits),dtype=np.intp,count=expected_n_splits)
+    assert(np.all(tr_sizes // vl_sizes == split))
+    for tr,vl in splits:
+        assert(_n_distinct(y,vl) == n_class)
+
+
+def test_n_distinct():
+    # the numba CI job must exercise the compiled helper
+    if os.environ.get('WITH_NUMBA') == '1':
+        assert(njit is not None)
+    rng = np.random.RandomState(12)
+    for size in [0,1,10,y.size]:
+        idx = rng.randint(0,y.size,size)
+        assert(_n_distinct(y,idx) == np.unique(y[idx]).size)
 
 
 class TestCV(unittest.TestCase):
@@ -40,38 +135,6 @@ class TestCV(unittest.TestCase):
         assert (X_train.shape[0] == y_train.shape[0] == g_train.shape[0])
         assert (X_test.shape[0] == y_test.shape[0] == g_test.shape[0])
         
-    def test_loo(self):
-        for split in [False,1,2,5]:
-            
-                cv = cross_validation.LeaveOneOut(n_repeats=split,random_state=split,verbose=split)
-                if split == False:
-                    assert(cv.get_n_splits(X,y)==np.min(np.unique(y,return_counts=True)[-1]))
-                else:
-                    assert(cv.get_n_splits(X,y)==split)
-                assert(cv.verbose == split)
-                
-                for tr,vl in cv.split(X,y):
-                    assert(tr.size == y.size-5)
-                    assert(vl.size == 5)
-                    assert(len(vl) == 5)
-                
-            
-    def test_kfold(self):
-        cv = cross_validation.RandomStratifiedKFold(valid_size=1/50)        
-
-        self.assertRaises(ValueError,cv.get_n_splits,X,y)
-        
-        for split in [1,2,5]:
-            cv = cross_validation.RandomStratifiedKFold(n_splits=1+split,n_repeats=split,verbose=split)
-            assert(cv.get_n_splits(X,y)==split*split+split)
-            assert(cv.verbose == split)
-            
-            for idx,[tr,vl] in enumerate(cv.split(X,y)):
-                assert(int(tr.size/vl.size) == split)
-                assert(np.unique(y[vl],return_counts=True)[0].size == 5)
-        
-            assert(idx+1 == split*split+split)
-            
     def test_LeavePSubGroupOut(self):
         
         cv = cross_validation.LeavePSubGroupOut(verbose=2)
@@ -96,7 +159,7 @@ class TestCV(unittest.TestCase):
             assert(not np.unique(np.in1d([1,2],[3,4]))[0])
         assert(np.all(np.unique(np.asarray(y_vl),return_counts=True)[1]==1))
 
-        list_files =cv.save_to_vector(vector,'Class',group='uniquefid',out_vector='/tmp/cv_g.gpkg')
+        list_files =cv.save_to_vector(vector,'Class',group='uniquefid',out_vector=os.path.join(tempdir,'cv_g.gpkg'))
 
         assert(len(list_files)==cv.get_n_splits(X,y,g))
         
@@ -109,18 +172,13 @@ class TestCV(unittest.TestCase):
                                                  random_state=12,verbose=1)
         
         
-        processing.sample_extraction(raster,vector,out_vector='/tmp/pixels.gpkg',verbose=False)
-        y_ = processing.read_vector_values('/tmp/pixels.gpkg','Class')
+        y_ = processing.read_vector_values(pixels,'Class')
         y_polygons = processing.read_vector_values(vector,'Class')
         assert(y_.size == y.size)
         assert(y_polygons.size != y_.size)
         
-        list_files=cv.save_to_vector('/tmp/pixels.gpkg','Class',out_vector='/tmp/cv.gpkg')
+        list_files=cv.save_to_vector(pixels,'Class',out_vector=os.path.join(tempdir,'cv.gpkg'))
         assert(len(list_files[0]) == 2)
-        for l in list_files:
-            for f in l:
-                os.remove(f)
-        os.remove('/tmp/pixels.gpkg')
         # to keep same size of training by a random selection
 
             
@@ -137,7 +195,7 @@ class TestCV(unittest.TestCase):
             y_asloo_vl.append(as_loo_cv[1])
             assert(n_class == len(y[sloo_cv[1]]))
             assert(sloo_cv[0].size == as_loo_cv[0].size) # same size between loo and sloo 
-            assert(np.all(sloo_cv[1] == as_loo_cv[1])) # using same valid pixel
+            assert(np.array_equal(sloo_cv[1],as_loo_cv[1])) # using same valid pixel
         
         assert(np.all(np.unique(np.asarray(y_vl),return_counts=True)[1]==1))
         assert(np.all(np.unique(np.asarray(y_asloo_vl),return_counts=True)[1]==1))
@@ -163,6 +221,29 @@ class TestCV(unittest.TestCase):
         self.assertRaises(ValueError,cv.get_n_splits,X,y)            
         
         
+    def test_condensed_distance_matrix(self):
+        assert(num_obs_y(distance_matrix_condensed) == y.size)
+        
+        # rows gathered from the condensed matrix match the square one
+        dcv = cross_validation._sample_selection.distanceCV(X,y,distance_matrix_condensed)
+        for idx in [0,1,y.size//2,y.size-1]:
+            assert(np.array_equal(dcv._distance_row(idx),distance_matrix[idx,:]))
+        # a condensed matrix must have a length of n*(n-1)/2
+        self.assertRaises(ValueError,cross_validation._sample_selection.distanceCV,X,y,distance_matrix_condensed[:-1])
+        
+        # same folds with the square and the condensed matrix
+        for cv_type,params,groups in [(cross_validation.SpatialLeaveOneOut,dict(distance_thresold=100),None),
+                                      (cross_validation.SpatialLeaveOneSubGroupOut,dict(distance_thresold=100,distance_label=g),g)]:
+            folds = []
+            for matrix in [distance_matrix,distance_matrix_condensed]:
+                cv = cv_type(distance_matrix=matrix,random_state=12,**params)
+                folds.append(list(cv.split(X,y,groups)))
+            
+            assert(len(folds[0]) == len(folds[1]) > 0)
+            for (tr,vl),(tr_condensed,vl_condensed) in zip(*folds):
+                assert(np.array_equal(tr,tr_condensed))
+                assert(np.array_equal(vl,vl_condensed))
+        
     def test_aside(self):
         
         SLOPO = cross_validation.SpatialLeaveAsideOut(valid_size=1/3,
@@ -171,8 +252,8 @@ class TestCV(unittest.TestCase):
         assert(SLOPO.get_n_splits(X,y) == int(1/(1/3)))
             
         for tr,vl in SLOPO.split(X,y):
-            assert(np.unique(y[vl]).size == 5) 
-            assert(np.unique(y[tr]).size == 5) 
+            assert(_n_distinct(y,vl) == n_class)
+            assert(_n_distinct(y,tr) == n_class)
         
         
     def test_slosgo(self)       :
@@ -185,34 +266,31 @@ class TestCV(unittest.TestCase):
             assert(n_class==np.unique(g[vl]).size)
         assert(np.all(np.unique(np.asarray(y_vl),return_counts=True)[1]==1))
         
-        processing.sample_extraction(raster,vector,out_vector='/tmp/pixels.gpkg',verbose=False)
         test_extensions = ['wrong','shp','gpkg']
         for extension in test_extensions:
             if extension == 'wrong':
 
-                self.assertRaises(Exception,cv.save_to_vector,'/tmp/pixels.gpkg','Class',out_vector='/tmp/SLOSGO.'+extension)
+                self.assertRaises(Exception,cv.save_to_vector,pixels,'Class',out_vector=os.path.join(tempdir,'SLOSGO.'+extension))
             else:
-                list_files = cv.save_to_vector('/tmp/pixels.gpkg','Class',out_vector='/tmp/SLOSGO.'+extension)
+                list_files = cv.save_to_vector(pixels,'Class',out_vector=os.path.join(tempdir,'SLOSGO.'+extension))
                 # test overwriting of previous files
-                list_files = cv.save_to_vector('/tmp/pixels.gpkg','Class',out_vector='/tmp/SLOSGO.'+extension) 
-                for tr,vl in list_files:
-                    assert(len(list_files[0]) == 2)
-                    for l in list_files:
-                        for f in l:     
-                            print(f)
-                            if os.path.exists(f):
-                                os.remove(f)
-                            
+                list_files = cv.save_to_vector(pixels,'Class',out_vector=os.path.join(tempdir,'SLOSGO.'+extension)) 
+                # one train and one valid file per fold, removed with the temporary directory
+                for files in list_files:
+                    assert(len(files) == 2)
 
         
     def test_compare_loo_kf(self):
         cv_loo = cross_validation.LeaveOneOut(random_state=12,verbose=2)
         cv_kf_as_loo = cross_validation.RandomStratifiedKFold(n_splits=False,valid_size=1,random_state=12,verbose=2)
-        for trvl_loo,trvl_kf in zip(cv_loo.split(X,y),cv_kf_as_loo.split(X,y)):
-            assert(np.all(trvl_loo[0]==trvl_kf[0]))
-            assert(np.all(trvl_loo[1]==trvl_kf[1]))
-            assert(len(trvl_kf[1]) == n_class)
-            assert(np.unique(y[trvl_kf[1]]).size == n_class)
+        # every fold has the same sizes, so folds stack into (n_folds, n_samples) arrays
+        tr_loo,vl_loo = map(np.stack,zip(*cv_loo.split(X,y)))
+        tr_kf,vl_kf = map(np.stack,zip(*cv_kf_as_loo.split(X,y)))
+        assert(np.array_equal(tr_loo,tr_kf))
+        assert(np.array_equal(vl_loo,vl_kf))
+        assert(vl_kf.shape[1] == n_class)
+        # one sample of each class per fold
+        assert(np.array_equal(np.sort(y[vl_kf],axis=1),np.broadcast_to(_labels,vl_kf.shape)))
         
         #to print extensions
         cv_loo.get_supported_extensions()
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 import unittest
+from unittest import mock
 from shutil import copyfile
 import numpy as np
 from museotoolbox import processing
 from museotoolbox.datasets import load_historical_data
-from osgeo import gdal, osr
+from osgeo import gdal, ogr, osr
 import os
+from pathlib import Path
 
 raster,vector = load_historical_data()
 rM = processing.RasterMath(raster)
@@ -75,6 +77,16 @@ class TestRaster(unittest.TestCase):
         assert(gdal.GDT_Byte == processing.get_gdt_from_minmax_values(max_value=222))
         assert(gdal.GDT_Float64 == processing.get_gdt_from_minmax_values(max_value =888E+40))
         assert(gdal.GDT_Float64 == processing.get_gdt_from_minmax_values(max_value=5,min_value = -888E+40))
+        # array-like values are reduced to their extreme
+        assert(gdal.GDT_UInt16 == processing.get_gdt_from_minmax_values([5,500]))
+        assert(gdal.GDT_Int16 == processing.get_gdt_from_minmax_values(np.array([1,5]),min_value=np.array([0,-5])))
+        
+    def test_convert_dt_warning(self):
+        # the warning is shown at each call, not only the first one
+        with mock.patch.object(processing,'push_feedback') as feedback:
+            for i in range(2):
+                assert(processing.convert_dt('int64') == gdal.GDT_Int32)
+            assert(feedback.call_count == 2)
         
     def test_rasterize(self):
         for invert in [True,False]:
@@ -83,7 +95,20 @@ class TestRaster(unittest.TestCase):
                 assert(mem.RasterCount == 1)
                 assert(mem.RasterXSize == rM.n_columns)
                 assert(mem.RasterYSize == rM.n_lines)
-            
+
+    def test_rasterize_opened_and_path(self):
+        # in-memory copy of the vector cannot be reopened by its name
+        shp = ogr.GetDriverByName('Memory').CopyDataSource(ogr.Open(vector),'mem_vector')
+        for invert in [True,False]:
+            mem = processing.rasterize(Path(raster),shp,out_image='MEM',invert=invert)
+            from_path = processing.rasterize(raster,Path(vector),out_image='MEM',invert=invert)
+            arr = mem.GetRasterBand(1).ReadAsArray()
+            assert(np.all(arr == from_path.GetRasterBand(1).ReadAsArray()))
+            assert(np.unique(arr).size == 2)
+        inside = processing.rasterize(raster,shp).GetRasterBand(1).ReadAsArray()
+        outside = processing.rasterize(raster,shp,invert=True).GetRasterBand(1).ReadAsArray()
+        assert(np.all((inside > 0) != (outside > 0)))
+
     def test_noImg(self)    :    
         
         self.assertRaises(ReferenceError,processing.RasterMath,'None',verbose=0)
@@ -133,6 +158,83 @@ class TestRaster(unittest.TestCase):
         assert(np.all(rM.get_random_block(random_state=12))== np.all(rM.get_random_block(random_state=12)))
         
         
+    def test_random_block_masked(self):
+        create_false_image(np.zeros((100,100),dtype=np.uint8),'/tmp/100x100_masked.tif')
+        rM_masked = processing.RasterMath('/tmp/100x100size.tif',in_image_mask='/tmp/100x100_masked.tif',verbose=0)
+        rM_masked.custom_block_size(10,10)
+        self.assertRaises(ValueError,rM_masked.get_random_block)
+        
+        # only the last block is unmasked
+        single_block = np.zeros((100,100),dtype=np.uint8)
+        single_block[90:,90:] = 1
+        create_false_image(single_block,'/tmp/100x100_single_block.tif')
+        rM_single = processing.RasterMath('/tmp/100x100size.tif',in_image_mask='/tmp/100x100_single_block.tif',verbose=0)
+        rM_single.custom_block_size(10,10)
+        # every random draw hits the first (masked) block, the scan has to find the last one
+        with mock.patch.object(np.random,'randint',return_value=np.zeros(8,dtype=int)):
+            block = rM_single.get_random_block()
+        assert(block.count() == 100)
+        assert(np.all(block.compressed() == 2))
+        assert(rM_single.get_random_block(random_state=12).count() == 100)
+        
+        os.remove('/tmp/100x100_masked.tif')
+        os.remove('/tmp/100x100_single_block.tif')
+        
+    def test_nodata_mask(self):
+        # the numba CI job must exercise the compiled kernel
+        if os.environ.get('WITH_NUMBA') == '1':
+            assert(processing._nodata_mask_numba is not None)
+        # compare the numba kernel (if available) with the numpy path
+        for kernel in [processing._nodata_mask_numba,None]:
+            with mock.patch.object(processing,'_nodata_mask_numba',kernel):
+                self._check_nodata_mask()
+        
+    def _check_nodata_mask(self):
+        arr = np.array([[1,2],[0,3],[4,0]],dtype=np.int16)
+        mask = np.array([True,True,False])
+        
+        assert(not processing._nodata_mask(arr).any())
+        assert(np.array_equal(processing._nodata_mask(arr,nodata=0),arr == 0))
+        assert(np.array_equal(processing._nodata_mask(arr,mask=mask),[[False,False],[False,False],[True,True]]))
+        assert(np.array_equal(processing._nodata_mask(arr,mask=mask,nodata=0),[[False,False],[True,False],[True,True]]))
+        # nodata out of the range of the dtype
+        assert(not processing._nodata_mask(arr,nodata=-99999).any())
+        # 3d block, mask per pixel
+        assert(np.array_equal(processing._nodata_mask(arr.reshape(1,3,2),mask=mask.reshape(1,3),nodata=0),
+                              [[[False,False],[True,False],[True,True]]]))
+        # large integer nodata is not rounded
+        big = np.array([[2**63+1,2**63]],dtype=np.uint64)
+        assert(np.array_equal(processing._nodata_mask(big,nodata=2**63+1),[[True,False]]))
+        # dtypes numba cannot handle
+        assert(np.array_equal(processing._nodata_mask(np.array([[True,False]]),nodata=0),[[False,True]]))
+        assert(np.array_equal(processing._nodata_mask(np.array([[1+1j,0j]]),nodata=0),[[False,True]]))
+        
+    def test_multiband_nodata(self):
+        # band 1 has nodata on the first line, band 0 is nodata everywhere in the second image
+        for path,first_band in [('/tmp/nodata_band.tif',1),('/tmp/nodata_first_band.tif',0)]:
+            bands = np.ones((3,10,10),dtype=np.uint8)
+            bands[1,0,:] = 0
+            bands[0,...] = first_band
+            src = gdal.GetDriverByName('GTiff').Create(path,10,10,3,gdal.GDT_Byte)
+            for idx in range(3):
+                src.GetRasterBand(idx+1).WriteArray(bands[idx])
+                src.GetRasterBand(idx+1).SetNoDataValue(0)
+            src = None
+            
+            for is_3d in [True,False]:
+                rM_nodata = processing.RasterMath(path,return_3d=is_3d,verbose=0)
+                rM_nodata.custom_block_size(-1,-1) # whole image in one block
+                block = rM_nodata.get_block(0,return_with_mask=True)
+                pixel_mask = block.mask.reshape(-1,3)
+                # same mask for every band of a pixel
+                assert(np.all(pixel_mask == pixel_mask[:,:1]))
+                if first_band:
+                    assert(pixel_mask[:10].all())
+                    assert(not pixel_mask[10:].any())
+                else:
+                    assert(pixel_mask.all())
+            os.remove(path)
+            
     def test_mask(self)            :
         for is_3d in [True, False]:
             mask = '/tmp/mask.tif'
@@ -198,6 +300,22 @@ class TestRaster(unittest.TestCase):
             
             os.remove('/tmp/mean.tif')
             
+    def test_extract_real_field(self):
+        copyfile(vector,'/tmp/test_real.gpkg')
+        src = ogr.Open('/tmp/test_real.gpkg',1)
+        lyr = src.GetLayer()
+        lyr.CreateField(ogr.FieldDefn('ratio',ogr.OFTReal))
+        for feat in lyr:
+            feat.SetField('ratio',feat.GetField('Class')+0.5)
+            lyr.SetFeature(feat)
+        src = None
+        
+        X,y,ratio = processing.extract_ROI(raster,'/tmp/test_real.gpkg','Class','ratio')
+        assert(y.dtype == np.int32)
+        assert(ratio.dtype == np.float64) # real field is not truncated
+        assert(np.all(ratio == y+0.5))
+        os.remove('/tmp/test_real.gpkg')
+        
     def test_unknow_fields(self):
         self.assertRaises(ValueError,processing.extract_ROI,raster,vector,'wrong_field')
         self.assertRaises(ValueError,processing.read_vector_values,vector)
@@ -239,6 +357,23 @@ class TestRaster(unittest.TestCase):
     def test_get_distance_matrix(self):
         distance_matrix,label = processing.get_distance_matrix(raster,vector,'Class')
         assert(label.size== distance_matrix.shape[0])
+        coords = processing.extract_ROI(raster,vector,only_pixel_position=True)
+        assert(np.array_equal(processing.get_distance_matrix_from_coords(coords),distance_matrix))
+        
+    def test_tiled_distance_matrix_memmap(self):
+        from scipy.spatial.distance import cdist
+        coords = np.random.RandomState(12).randint(0,500,size=(20,2))
+        expected = cdist(coords,coords).astype(np.uint64)
+        # no memory available : the matrix is mapped to a temporary file
+        low_memory = mock.Mock(return_value=mock.Mock(available=0))
+        with mock.patch.object(processing,'virtual_memory',low_memory):
+            # tiles smaller than the matrix, including a partial last one
+            distance_matrix = processing._tiled_distance_matrix(coords,tile=7)
+        assert(isinstance(distance_matrix,np.memmap))
+        assert(np.array_equal(distance_matrix,expected))
+        in_memory = processing._tiled_distance_matrix(coords,tile=7)
+        assert(not isinstance(in_memory,np.memmap))
+        assert(np.array_equal(in_memory,expected))
         
 if __name__ == "__main__":
     unittest.main()